@@ -1,18 +1,24 @@
 #!/usr/bin/env python3
-import heapq
 import sys
 import shutil
+import shlex
 import subprocess
-import itertools
 import csv
 import time
-import dataclasses
+import typing
 import math
 import sqlite3
+import contextlib
+import functools
 import argparse
 import os
 import pathlib
 
+try:
+    import cisv
+except ImportError:
+    cisv = None
+
 
 DEFAULT_DECK = 'default'
 
@@ -34,7 +40,7 @@ Use the `add` subcommand to add new cards as csv files.  Afterwards, to review w
 
 Cards are saved to an SQLite database in the user's config directory, under the `serious` subdirectory.  This can be changed with `--db-path`.
 
-If the `SERIOUS_TTS` environment variable is not empty, then it is assumed to be the name of a text-to-speech program, and questions and answers are piped to it.
+If the `SERIOUS_TTS` environment variable is not empty, then it is assumed to be the name of a text-to-speech program, optionally followed by its arguments, and questions and answers are piped to it.  The program is run directly rather than through a shell.
 
 Each card is reviewed at time intervals `t` (in hours) according to
 
@@ -76,6 +82,12 @@ where `n` is the number of consecutive, successfully recalled reviews of a given
         default=24 * 90,
         help='Paramater of the spacing algorithm.  Denotes the maximum number of hours between reviews of the same card.  Default is `24 * 90` hours.',
     )
+    parser.add_argument(
+        '--full-history',
+        action='store_true',
+        default=False,
+        help='Record the whole review history of each card.  By default, only the 5 most recent reviews are kept.',
+    )
 
     subparsers = parser.add_subparsers()
 
@@ -115,117 +127,179 @@ where `n` is the number of consecutive, successfully recalled reviews of a given
     )
 
     args = parser.parse_args()
-    args.decks = list(filter(None, args.decks.strip().split(',')))
+    args.decks = [deck.strip() for deck in args.decks.split(',') if deck.strip()]
     return args
 
 
-@dataclasses.dataclass(frozen=True)
-class Item:
-    rowid: int = 0
-    review_time: int = 0
-    trial: int = 0
-
-    def __lt__(self, b):
-        return self.review_time < b.review_time
-
-
-@dataclasses.dataclass(frozen=True)
-class ReviewItem:
-    item: Item
+class Item(typing.NamedTuple):
+    rowid: int
+    trial: int
     recalled: int
     forgot: int
     question: str
     answer: str
-    history: str
-
-
-def add_success(item, intervals):
+    recent_bits: int
+
+
+class RadixHeap:
+    """
+    Monotone priority queue of tuples keyed on their first element.
+
+    Keys must be non-negative integers, and a pushed key must not be
+    smaller than the key most recently popped.  `start_review` ensures
+    this by never rescheduling a card earlier than the time at which it
+    was popped, even if the clock is set back.
+    """
+
+    __slots__ = ('_last', '_size', '_buckets')
+
+    def __init__(self, entries=()):
+        self._last = 0
+        self._size = 0
+        self._buckets = [[] for _ in range(65)]
+        for entry in entries:
+            self.push(entry)
+
+    def __len__(self):
+        return self._size
+
+    def push(self, entry):
+        self._buckets[(entry[0] ^ self._last).bit_length()].append(entry)
+        self._size += 1
+
+    def peek(self):
+        if not self._buckets[0]:
+            self._redistribute()
+        return self._buckets[0][-1]
+
+    def pop(self):
+        entry = self.peek()
+        self._buckets[0].pop()
+        self._size -= 1
+        return entry
+
+    def _redistribute(self):
+        # Bucket `i` holds keys whose highest bit differing from
+        # `self._last` is bit `i - 1`, so the smallest key lies in the
+        # lowest non-empty bucket.  Every other key in that bucket
+        # moves to a strictly lower one relative to the new minimum.
+        i = next(i for i, bucket in enumerate(self._buckets) if bucket)
+        bucket = self._buckets[i]
+        self._buckets[i] = []
+        self._last = min(bucket)[0]
+        for entry in bucket:
+            self._buckets[(entry[0] ^ self._last).bit_length()].append(entry)
+
+
+def add_success(item, intervals, now):
     return _update_items(
         item,
         intervals,
+        now,
         min(len(intervals) - 1, item.trial + 1),
+        recalled=item.recalled + 1,
+        recent_bits=((item.recent_bits << 1) | 1) & 0b11111,
     )
 
 
-def add_failure(item, intervals):
-    return _update_items(item, intervals, item.trial // 2)
+def add_failure(item, intervals, now):
+    return _update_items(
+        item,
+        intervals,
+        now,
+        item.trial // 2,
+        forgot=item.forgot + 1,
+        recent_bits=(item.recent_bits << 1) & 0b11111,
+    )
 
 
-def _update_items(item, intervals, trial):
-    return dataclasses.replace(
-        item,
-        trial=trial,
-        review_time=int(time.time() + intervals[trial]),
+def _update_items(item, intervals, now, trial, **changes):
+    return (
+        now + intervals[trial],
+        item._replace(trial=trial, **changes),
     )
 
 
 def compute_intervals(trials, hours):
-    c = math.log(hours + 1) / trials
-    return [(math.exp(n * c) - 1) * 60 * 60 for n in range(trials + 1)]
+    c = math.log1p(hours) / trials
+    return tuple(round(math.expm1(n * c) * 60 * 60) for n in range(trials + 1))
 
 
 def load_items(db, decks):
-    where_clause = 'WHERE {}'.format('OR'.join(['(deck = ?)' for _ in decks]))
-    with db:
-        items = list(
-            itertools.starmap(
-                Item,
-                db.execute(
-                    'SELECT rowid, review_time, trial FROM Item {}'.format(
-                        where_clause if decks else '',
-                    ),
-                    decks,
-                ),
-            )
+    where_clause = (
+        'WHERE deck IN ({})'.format(', '.join('?' * len(decks))) if decks else ''
+    )
+    return RadixHeap(
+        (row[0], Item._make(row[1:]))
+        for row in db.execute(
+            """
+            SELECT
+                review_time,
+                rowid, trial, recalled, forgot, question, answer, recent_bits
+            FROM Item {}
+            """.format(where_clause),
+            decks,
         )
-        heapq.heapify(items)
-        return items
+    )
 
 
-def update_item(item, db, success=True):
-    with db:
-        db.execute(
-            """
-            UPDATE Item
-            SET
-                review_time = ?,
-                trial = ?,
-                {recalled} = {recalled} + 1,
-                history = history || {trial_success}
-            WHERE rowid = ?
-            """.format(
-                recalled='recalled' if success else 'forgot',
-                trial_success='"o"' if success else '"x"',
-            ),
-            (item.review_time, item.trial, item.rowid),
-        )
+def _make_update_sql(success, full_history):
+    # The new card state is computed once, by `add_success` and
+    # `add_failure`, and bound as parameters; only the optional full
+    # history is appended in SQL.
+    return """
+        UPDATE Item
+        SET
+            review_time = ?,
+            trial = ?,
+            recalled = ?,
+            forgot = ?,
+            {history}
+            recent_bits = ?
+        WHERE rowid = ?
+        """.format(
+        history=(
+            'history = history || {},'.format('"o"' if success else '"x"')
+            if full_history
+            else ''
+        ),
+    )
 
 
-def make_review_item(item, db):
-    with db:
-        row = db.execute(
-            """
-            SELECT
-                recalled, forgot, question, answer, history
-            FROM Item
-            WHERE rowid = ?
-            """,
-            (item.rowid,),
-        ).fetchone()
-
-        return ReviewItem(
-            item,
-            row[0],
-            row[1],
-            row[2],
-            row[3],
-            row[4],
-        )
+# Keyed on `(success, full_history)`.  Reusing the same strings lets
+# sqlite3's statement cache skip re-preparing them on every review.
+_UPDATE_SQL = {
+    (success, full_history): _make_update_sql(success, full_history)
+    for success in (True, False)
+    for full_history in (True, False)
+}
+
+
+def update_item(entry, db, success=True, full_history=False):
+    review_time, item = entry
+    db.execute(
+        _UPDATE_SQL[success, full_history],
+        (
+            review_time,
+            item.trial,
+            item.recalled,
+            item.forgot,
+            item.recent_bits,
+            item.rowid,
+        ),
+    )
 
 
 def make_db(filename):
-    db = sqlite3.connect(filename)
+    # In autocommit mode, single statements such as a review's UPDATE
+    # commit on their own; multi-statement writes open an explicit
+    # transaction with `BEGIN IMMEDIATE`.
+    db = sqlite3.connect(filename, isolation_level=None)
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute('PRAGMA temp_store = MEMORY')
     with db:
+        db.execute('BEGIN IMMEDIATE')
         db.execute(
             """
             CREATE TABLE IF NOT EXISTS Item (
@@ -236,97 +310,165 @@ def make_db(filename):
                 review_time INT DEFAULT 0,
                 trial INT DEFAULT 0,
                 history VARCHAR DEFAULT "",
-                deck VARCHAR DEFAULT "{}"
+                deck VARCHAR DEFAULT "{}",
+                recent_bits INT DEFAULT 0
                 )
             """.format(DEFAULT_DECK)
         )
+        _add_recent_bits(db)
         db.execute('CREATE INDEX IF NOT EXISTS Item_deck ON Item (deck)')
         return db
 
 
-def _import_batch_to_db(db, batch):
+def _add_recent_bits(db):
+    # Databases created before `recent_bits` existed get the column filled
+    # in from the last 5 entries of their full history.
+    if 'recent_bits' in {row[1] for row in db.execute('PRAGMA table_info(Item)')}:
+        return
+    db.execute('ALTER TABLE Item ADD COLUMN recent_bits INT DEFAULT 0')
+    db.executemany(
+        'UPDATE Item SET recent_bits = ? WHERE rowid = ?',
+        [
+            (sum(1 << i for i, c in enumerate(history[::-1]) if c == 'o'), rowid)
+            for rowid, history in db.execute(
+                'SELECT rowid, substr(history, -5) FROM Item'
+            )
+        ],
+    )
+
+
+def _import_rows_to_db(db, rows):
     with db:
+        db.execute('BEGIN IMMEDIATE')
         db.executemany(
-            'INSERT INTO Item (question, answer, recalled, forgot, review_time, trial, history, deck) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
-            batch,
+            'INSERT INTO Item (question, answer, recalled, forgot, review_time, trial, history, deck, recent_bits) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            rows,
         )
 
 
-def _insert_into_item(deck):
-    def f(db, batch):
-        with db:
-            db.executemany(
-                'INSERT INTO Item (question, answer, deck) VALUES (?, ?, ?)',
-                (b + [deck] for b in batch),
-            )
-
-    return f
+def _insert_into_item(db, rows, deck):
+    # `executemany` consumes the generator row by row, so whole files are
+    # inserted in a single transaction without being held in memory.
+    with db:
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany(
+            'INSERT INTO Item (question, answer, deck) VALUES (?, ?, ?)',
+            (row + [deck] for row in rows),
+        )
 
 
-def batch_sql_op(db, op, rows, batch_size=1000):
-    batch = []
-    for row in rows:
-        batch.append(row)
-        if len(batch) >= batch_size:
-            op(db, batch)
-            batch = []
-    if batch:
-        op(db, batch)
-        batch = []
+def _get_tts_argv():
+    try:
+        argv = shlex.split(os.environ.get('SERIOUS_TTS', ''))
+    except ValueError as err:
+        print('Ignoring `SERIOUS_TTS`: {}'.format(err), file=sys.stderr)
+        return []
+    if argv and not shutil.which(argv[0]):
+        print(
+            'Ignoring `SERIOUS_TTS`: program `{}` not found'.format(argv[0]),
+            file=sys.stderr,
+        )
+        return []
+    return argv
 
 
 def _prompt(prompt, tts_text):
     print(prompt, end='')
-    if tts_program := os.environ.get('SERIOUS_TTS', ''):
-        subprocess.run(tts_program, input=tts_text, text=True, shell=True)
     return input()
 
 
-def review(review_item):
+def _prompt_with_tts(tts_argv, prompt, tts_text):
+    print(prompt, end='')
+    try:
+        subprocess.run(tts_argv, input=tts_text, text=True)
+    except OSError as err:
+        print('\nError running `SERIOUS_TTS`: {}'.format(err), file=sys.stderr)
+    return input()
+
+
+def _make_prompt():
+    # `SERIOUS_TTS` is resolved once per review session, so commands that
+    # don't review aren't affected by a bad value.
+    if tts_argv := _get_tts_argv():
+        return functools.partial(_prompt_with_tts, tts_argv)
+    return _prompt
+
+
+_HISTORY_GLYPHS = str.maketrans('10', 'ox')
+
+
+def review(review_item, prompt=_prompt):
+    # Bit `i` of `recent_bits` is set if the `i`-th most recent review was
+    # recalled; only as many bits as there were reviews are meaningful.
+    n_trials = review_item.recalled + review_item.forgot
+    history = format(review_item.recent_bits, '05b')[::-1][:n_trials]
     status = '{recalled}/{n_trials} {history}'.format(
         recalled=review_item.recalled,
-        n_trials=review_item.recalled + review_item.forgot,
-        history=(review_item.history[-5:][::-1] + '-----')[:5],
+        n_trials=n_trials,
+        history=history.translate(_HISTORY_GLYPHS).ljust(5, '-'),
     )
     q_prompt = f'{status}\nQ: {review_item.question}\nreveal [a]nswer, [q]uit: '
     ans_prompt = f'A: {review_item.answer}\n[r]ecalled, [f]orgot: '
     while True:
-        x = _prompt(q_prompt, review_item.question)
+        x = prompt(q_prompt, review_item.question)
         if x == 'q':
             return None
         if x != 'a':
             continue
         while True:
-            y = _prompt(ans_prompt, review_item.answer)
+            y = prompt(ans_prompt, review_item.answer)
             if y == 'r':
                 return True
             elif y == 'f':
                 return False
 
 
+def _read_csv(filename, delimiter):
+    # `cisv` is an optional, SIMD-accelerated parser; fall back to the
+    # standard library when it's not installed.
+    if cisv:
+        with cisv.open_iterator(filename, delimiter=delimiter) as reader:
+            yield from reader
+    else:
+        with open(filename, newline='') as fis:
+            yield from csv.reader(fis, delimiter=delimiter)
+
+
 def add_items_from_files(db, args):
     for csv_filename in args.filenames:
         try:
-            with open(csv_filename) as fis:
-                batch_sql_op(
-                    db,
-                    _insert_into_item(args.deck),
-                    csv.reader(fis, delimiter=args.delimiter),
-                )
+            _insert_into_item(
+                db,
+                _read_csv(csv_filename, args.delimiter),
+                args.deck,
+            )
         except sqlite3.IntegrityError:
             print(f'Duplicate question in file `{csv_filename}`')
 
 
 def start_review(items, db, intervals, args):
-    while items and (items[0].review_time <= time.time()):
-        item = heapq.heappop(items)
-        if (result := review(make_review_item(item, db))) == True:
-            item = add_success(item, intervals)
-            update_item(item, db)
+    # The clock is read once per card, after it's answered, and the same
+    # reading both reschedules the card and decides whether the next one
+    # is due.  It's clamped to the popped review time so that keys pushed
+    # back onto the heap stay monotone if the clock steps backwards.
+    prompt = None
+    now = int(time.time())
+    while items and (items.peek()[0] <= now):
+        entry = items.pop()
+        # Resolved on the first due card, so sessions with nothing to
+        # review never look at `SERIOUS_TTS`.
+        prompt = prompt or _make_prompt()
+        result = review(entry[1], prompt)
+        now = max(int(time.time()), entry[0])
+        if result == True:
+            entry = add_success(entry[1], intervals, now)
+            update_item(entry, db, full_history=args.full_history)
         elif result == False:
-            item = add_failure(item, intervals)
-            update_item(item, db, success=False)
-        heapq.heappush(items, item)
+            entry = add_failure(entry[1], intervals, now)
+            update_item(
+                entry, db, success=False, full_history=args.full_history
+            )
+        items.push(entry)
         print()
         if result == None:
             break
@@ -334,12 +476,12 @@ def start_review(items, db, intervals, args):
 
 def _export_to_csv(db_path, out_file):
     with (
-        sqlite3.connect(db_path) as db,
+        contextlib.closing(sqlite3.connect(db_path)) as db,
         open(out_file, mode='w') as fos,
     ):
         csv.writer(fos).writerows(
             db.execute(
-                'SELECT question, answer, recalled, forgot, review_time, trial, history, deck FROM Item'
+                'SELECT question, answer, recalled, forgot, review_time, trial, history, deck, recent_bits FROM Item'
             )
         )
 
@@ -347,11 +489,13 @@ def _export_to_csv(db_path, out_file):
 def _import_db(csv_filename, db_name):
     try:
         tmp_db_name = os.path.join(_get_config_dir(), 'tmp.db')
+        # The connection must be closed before moving the file so that
+        # the write-ahead log is checkpointed into it.
         with (
-            make_db(tmp_db_name) as tmp_db,
+            contextlib.closing(make_db(tmp_db_name)) as tmp_db,
             open(csv_filename) as fis,
         ):
-            batch_sql_op(tmp_db, _import_batch_to_db, csv.reader(fis))
+            _import_rows_to_db(tmp_db, csv.reader(fis))
         shutil.move(tmp_db_name, db_name)
     except Exception as err:
         print('Error importing csv data: {}'.format(err), file=sys.stderr)
@@ -378,16 +522,17 @@ def main():
     os.makedirs(_get_config_dir(), exist_ok=True)
 
     args = _get_cmdline_args()
-    db = make_db(args.db_path)
-    intervals = compute_intervals(args.reviews_param, args.hours_param)
 
     if args.show_intervals:
-        print(intervals)
+        print(compute_intervals(args.reviews_param, args.hours_param))
         return
+
+    db = make_db(args.db_path)
     if 'filenames' in vars(args):
         add_items_from_files(db, args)
         return
     if 'editor' in vars(args):
+        db.close()
         if not edit(args):
             print(
                 'No editor specified.  Use `--editor` or define the `EDITOR` environment variable.',
@@ -395,9 +540,10 @@ def main():
             )
         return
 
+    intervals = compute_intervals(args.reviews_param, args.hours_param)
     if items := load_items(db, args.decks):
         start_review(items, db, intervals, args)
-        print('Next review scheduled for {}.'.format(time.ctime(items[0].review_time)))
+        print('Next review scheduled for {}.'.format(time.ctime(items.peek()[0])))
     else:
         print('No cards scheduled for review.  Use the `add` sub-command to add some.')
 